@@ -0,0 +1,125 @@
+"""
+Load shedding for the activity poller
+
+The controller measures each tick and decides how many users the next one
+polls, with how many workers, and which low-priority events are deferred
+to a digest instead of being posted right away.
+"""
+
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Events deferred to a digest while the poller is under pressure
+LOW_PRIORITY_EVENTS = ["FollowActivity"]
+
+
+class LoadController:
+    """
+    Adjust the poller's work from the duration of the previous ticks
+
+    The batch is sized from the measured time per user so a tick fits in its
+    budget, it is cut when a tick overruns or a run is missed, and doubles
+    back once ticks are fast again.
+    """
+    def __init__(self, interval, min_batch=10, max_batch=None, min_workers=1, max_workers=8, max_error_rate=0.2):
+        """
+        :param interval: Seconds between two ticks
+        :param min_batch: Least number of users polled per tick
+        :param max_batch: Most number of users polled per tick, None for no limit
+        :param min_workers: Least number of users polled at the same time
+        :param max_workers: Most number of users polled at the same time
+        :param max_error_rate: Share of failed users above which the workers are cut
+        """
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        # A tick should leave half of the interval free
+        self.budget = interval / 2
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+
+        # None polls every user
+        self.batch_size = max_batch
+        self.workers = min_workers
+        self.under_pressure = False
+        self.seconds_per_user = None
+        self.last_duration = None
+        self.pending = 0
+        self._lock = Lock()
+
+    @property
+    def deferred_events(self) -> list[str]:
+        """Event types that should go to a digest instead of being posted"""
+        return LOW_PRIORITY_EVENTS if self.under_pressure else []
+
+    def record_tick(self, duration, polled, pending, errors, rate_limited=0):
+        """
+        Adapt the next tick to the one that just finished
+
+        :param duration: Seconds the tick took
+        :param polled: Number of users polled
+        :param pending: Number of users left for the next ticks
+        :param errors: Number of users that failed to be polled
+        :param rate_limited: Number of users that failed because of a rate limit
+        """
+        with self._lock:
+            self.last_duration = duration
+            self.pending = pending
+
+            if polled > 0:
+                per_user = duration / polled
+                if self.seconds_per_user is None:
+                    self.seconds_per_user = per_user
+                else:
+                    self.seconds_per_user = (self.seconds_per_user + per_user) / 2
+
+            # Users left behind only mean pressure if the tick was too long
+            overran = duration > self.budget
+            self.under_pressure = overran
+
+            # A few accounts failing every tick (deleted, private, archived
+            # channel) isn't a reason to slow everyone down
+            if rate_limited > 0 or (polled > 0 and errors / polled > self.max_error_rate):
+                self.workers = max(self.min_workers, self.workers // 2)
+            elif overran or pending > 0:
+                self.workers = min(self.max_workers, self.workers + 1)
+
+            # Grow from what was actually polled, not from an unused larger batch
+            batch_size = polled if self.batch_size is None else min(self.batch_size, max(polled, self.min_batch))
+            if overran:
+                batch_size = int(batch_size * self.budget / duration)
+            else:
+                batch_size *= 2
+
+            if self.seconds_per_user:
+                # Never more than what fits in the budget at the measured pace
+                batch_size = min(batch_size, int(self.budget / self.seconds_per_user))
+
+            batch_size = max(self.min_batch, batch_size)
+            if self.max_batch is not None:
+                batch_size = min(self.max_batch, batch_size)
+            self.batch_size = batch_size
+
+        logger.info("Polled %d users in %.1fs, %d failed: %s", polled, duration, errors, self)
+
+    def record_missed_run(self):
+        """Called when the scheduler skipped a run because the previous one was still going"""
+        with self._lock:
+            self.under_pressure = True
+            if self.batch_size is not None:
+                self.batch_size = max(self.min_batch, self.batch_size // 2)
+
+        logger.warning("Poller missed a run: %s", self)
+
+    def __str__(self):
+        if self.under_pressure:
+            state = "under pressure"
+        elif self.pending > 0:
+            state = "catching up"
+        else:
+            state = "ok"
+        batch = "all" if self.batch_size is None else self.batch_size
+        return f"{state}, batch={batch}, workers={self.workers}, pending={self.pending}"
@@ -3,10 +3,15 @@ Generate Slack blocks
 """
 
 import os
+from posters import poster_url
 from schemas import DiaryEntryActivity, Film
 from utils import star_to_text, html_to_mrkdwn, shorten_text
 
 
+SLACK_MAX_BLOCKS = 50
+SLACK_MAX_SECTION_TEXT = 3000
+
+
 def get_url_id(film:Film):
     # Some magic cuz sometime the sortingName isnt the name in the URL
     return os.path.basename(film.links["letterboxd"].url.strip("/"))
@@ -50,21 +55,24 @@ def from_diaryentry(activity: DiaryEntryActivity):
 
     sorting_name = get_url_id(film)
 
-    return [
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*{member.display_name} watched {film_name}*\n{liked} {stars}{review}",
-            },
-            "accessory": {
-                "type": "image",
-                "image_url": film.poster.sizes[
-                    len(film.poster.sizes) // 2
-                ].url,  # Take the average quality
-                "alt_text": f"{film.name}'s poster",
-            },
+    section = {
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": f"*{member.display_name} watched {film_name}*\n{liked} {stars}{review}",
         },
+    }
+
+    image_url = poster_url(film)
+    if image_url is not None:
+        section["accessory"] = {
+            "type": "image",
+            "image_url": image_url,
+            "alt_text": f"{film.name}'s poster",
+        }
+
+    return [
+        section,
         {
             "type": "actions",
             "elements": [
@@ -159,21 +167,22 @@ def modal_info(user):
     """
     Create a modal containing user's informations
 
-    :param user: User tuple (slack_id, letterboxd_id, channel_id, ?, events_list)
+    :param user: Linked account
+    :type user: Account
     :return: Slack modal object with user information and event status
     :rtype: dict
     """
     infos = [
-        f"Slack ID: `{user[0]}` <@{user[0]}>",
-        f"Letterboxd ID: `{user[1]}`",  # <https://letterboxd.com/{}/|{}>",
-        f"Channel: `{user[2]}` <#{user[2]}>" if user[2] else "Channel: None",
+        f"Slack ID: `{user.slack_id}` <@{user.slack_id}>",
+        f"Letterboxd ID: `{user.boxd_id}`",  # <https://letterboxd.com/{}/|{}>",
+        f"Channel: `{user.channel}` <#{user.channel}>" if user.channel else "Channel: None",
     ]
     infos = "\n".join(infos)
 
     events = [
         (
             f":ms-tick-box:  {event}"
-            if event in user[4]
+            if event in user.events
             else f":ms-large-white-square:  {event}"
         )
         for event in _ALL_EVENTS
@@ -204,3 +213,103 @@ def watchlist_pick(film:Film):
             "text": f":game_die: Picked *<https://letterboxd.com/film/{get_url_id(film)}|{film.full_display_name}>*"
         }
     }]
+
+
+def stats(slack_id, ratings, genres, months, overlap=None):
+    """
+    Create blocks summarizing someone's activity history
+
+    :param slack_id: Slack ID of the user the stats are about
+    :param ratings: (rating, count) from the diary
+    :param genres: (genre, count) of the most logged genres
+    :param months: (month, count) of logged films per month
+    :param overlap: (film_id, film_name, url, rating) in both watchlists, None to hide it
+    :return: List of Slack blocks
+    :rtype: list[dict]
+    """
+    def bars(rows, label):
+        if len(rows) == 0:
+            return "_Nothing logged yet_"
+
+        top = max(count for _, count in rows)
+        return "\n".join(
+            f"{label(value)} `{'█' * max(1, round(count / top * 10))}` {count}"
+            for value, count in rows
+        )
+
+    sections = [
+        f"*Letterboxd stats of <@{slack_id}>*",
+        "*Ratings*\n" + bars(ratings, star_to_text),
+        "*Top genres*\n" + bars(genres, lambda genre: genre),
+        "*Films per month*\n" + bars(months, lambda month: f"`{month}`"),
+    ]
+
+    if overlap is not None:
+        films = "\n".join(f"• {film[1]}" for film in overlap) or "_No film in common_"
+        sections.append("*In both watchlists*\n" + films)
+
+    return [
+        {"type": "section", "text": {"type": "mrkdwn", "text": section}}
+        for section in sections
+    ]
+
+
+def together_pick(slack_ids, films, ranked=False):
+    """
+    Create blocks listing films from everyone's watchlist
+
+    :param slack_ids: Slack IDs of the participants
+    :param films: (film_id, film_name, url, rating) in every watchlist
+    :param ranked: Whether films are sorted by rating instead of picked randomly
+    :return: List of Slack blocks
+    :rtype: list[dict]
+    """
+    people = ", ".join(f"<@{slack_id}>" for slack_id in slack_ids)
+
+    def film_link(film):
+        _, name, url, rating = film
+        rating = f" ({rating:.1f}/5)" if rating is not None else ""
+        return f"*<{url}|{name}>*{rating}" if url else f"*{name}*{rating}"
+
+    if ranked:
+        lines = [f"{i}. {film_link(film)}" for i, film in enumerate(films, start=1)]
+        text = f":trophy: Best rated films on the watchlists of {people}\n" + "\n".join(lines)
+    else:
+        text = f":game_die: Picked {film_link(films[0])} for {people}"
+
+    return from_mrkdwn(text)
+
+
+def digest(title, lines):
+    """
+    Merge many messages into compact digest messages
+
+    Lines are packed in as few sections as possible, and a new message is
+    started every time Slack's block limit is reached.
+
+    :param title: Title shown at the top of the first message
+    :param lines: Mrkdwn text of each buffered message
+    :return: Blocks of each message to send
+    :rtype: list[list[dict]]
+    """
+    sections = []
+    current = ""
+    for line in lines:
+        line = "• " + line[:SLACK_MAX_SECTION_TEXT - 3]
+        if current and len(current) + len(line) + 1 > SLACK_MAX_SECTION_TEXT:
+            sections.append(current)
+            current = ""
+
+        current = f"{current}\n{line}" if current else line
+
+    if current:
+        sections.append(current)
+
+    message_blocks = from_mrkdwn(f"*{title}*")
+    for section in sections:
+        message_blocks += from_mrkdwn(section)
+
+    return [
+        message_blocks[i:i + SLACK_MAX_BLOCKS]
+        for i in range(0, len(message_blocks), SLACK_MAX_BLOCKS)
+    ]
@@ -0,0 +1,227 @@
+"""
+Command line tools to manage linked accounts and replay archived polls
+
+Examples:
+    python cli.py export accounts.parquet
+    python cli.py import accounts.csv --usernames --verify --backfill 7
+    python cli.py replay data/letterboxd.jsonl.gz --days 30 --database data/database.db
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from threading import Lock
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from database import init_db, get_user, get_configured_users, export_accounts, read_accounts_file, import_accounts, record_activities, record_posts
+
+
+def _check_account(boxd_client, account, usernames, verify):
+    """
+    Resolve and verify one imported account
+
+    :return: The error message, None if the account can be imported
+    :rtype: str or None
+    """
+    try:
+        return _check_boxd_account(boxd_client, account, usernames, verify)
+    except Exception as e:
+        return str(e)
+
+
+def _check_boxd_account(boxd_client, account, usernames, verify):
+    if usernames:
+        username = account["boxd_username"]
+        boxdid = boxd_client.get_id_by_username(username)
+        if boxdid is None:
+            return f"Couldn't find any username named {username}"
+
+        account["boxd_username"] = boxdid
+
+    if verify:
+        bio = boxd_client.get_member(account["boxd_username"])["bio"]
+        if account["slack_id"] not in bio:
+            return "Slack ID isn't in the Letterboxd bio"
+
+    return None
+
+
+def _boxd_client():
+    """Letterboxd client configured like the bot's, without its archive"""
+    from letterboxd import LetterboxdClient
+
+    return LetterboxdClient(
+        client_id=os.getenv("BOXD_CLIENT_ID"),
+        client_secret=os.getenv("BOXD_CLIENT_SECRET"),
+        username=os.getenv("BOXD_USERNAME"),
+        password=os.getenv("BOXD_PASSWORD"),
+        baseurl=os.getenv("BOXD_API_URL"),
+    )
+
+
+def cmd_export(args):
+    init_db()
+    export_accounts(args.path, args.format)
+    print(f"Exported accounts to {args.path}")
+
+
+def cmd_import(args):
+    init_db()
+    accounts = read_accounts_file(args.path, args.format)
+
+    if args.usernames or args.verify:
+        boxd_client = _boxd_client()
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            errors = list(pool.map(
+                lambda account: _check_account(boxd_client, account, args.usernames, args.verify),
+                accounts,
+            ))
+
+        for account, error in zip(accounts, errors):
+            if error is not None:
+                print(f"Skipped {account['slack_id']}: {error}")
+
+        accounts = [account for account, error in zip(accounts, errors) if error is None]
+
+    failed = import_accounts(accounts)
+    for account, error in failed:
+        print(f"Skipped {account['slack_id']}: {error}")
+
+    failed_ids = {account["slack_id"] for account, _ in failed}
+    imported = [account["slack_id"] for account in accounts if account["slack_id"] not in failed_ids]
+    print(f"Imported {len(imported)} accounts")
+
+    if args.backfill:
+        from slack_sdk import WebClient
+        from poller import post_user_activities
+
+        boxd_client = _boxd_client()
+        slack_client = WebClient(
+            token=os.getenv("SLACK_BOT_TOKEN"),
+            base_url=os.getenv("SLACK_API_URL", WebClient.BASE_URL),
+        )
+
+        since = datetime.now(timezone.utc) - timedelta(days=args.backfill)
+        users = [get_user(slack_id) for slack_id in imported]
+        users = [user for user in users if user.channel is not None]
+
+        posts = []
+
+        def backfill(user):
+            try:
+                return post_user_activities(user, boxd_client, slack_client, since=since, posts=posts)
+            except Exception as e:
+                print(f"Unable to backfill {user.slack_id}: {e}")
+                return None
+
+        try:
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                results = list(pool.map(backfill, users))
+        finally:
+            record_posts(posts)
+
+        record_activities([activity for result in results if result for activity in result])
+        print(f"Backfilled {len(users) - results.count(None)} channels")
+
+
+class _DryRunSlackClient:
+    """
+    Stand-in for the Slack client during a replay, it only counts messages
+    """
+    def __init__(self):
+        self.messages = 0
+        self._lock = Lock()
+
+    def chat_postMessage(self, channel, **kwargs):
+        with self._lock:
+            self.messages += 1
+            return {"channel": channel, "ts": f"{time.time():.6f}"}
+
+
+def cmd_replay(args):
+    # Replays run on a copy of the database, so lastUpdate, the history and
+    # the post registry of the running bot are never touched
+    import database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database.DB_PATH = os.path.join(tmpdir, "replay.db")
+        for suffix in ("", ".wal"):
+            if os.path.exists(args.database + suffix):
+                shutil.copy(args.database + suffix, database.DB_PATH + suffix)
+        init_db()
+
+        from poller import post_user_activities
+        from letterboxd import ArchiveReplayClient
+
+        boxd_client = ArchiveReplayClient(args.archive)
+        slack_client = _DryRunSlackClient()
+
+        since = datetime.now(timezone.utc) - timedelta(days=args.days)
+        start = time.monotonic()
+        new_activities = []
+        posts = []
+        for user in get_configured_users():
+            new_activities += post_user_activities(user, boxd_client, slack_client, since=since, posts=posts)
+
+        record_posts(posts)
+        record_activities(new_activities)
+        elapsed = time.monotonic() - start
+
+    print(f"Replayed {len(boxd_client.files)} archive files in {elapsed:.2f}s")
+    print(f"{len(new_activities)} activities, {slack_client.messages} messages would have been posted")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage Orpheus Le Gorila accounts")
+    subparsers = parser.add_subparsers(required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export accounts to a CSV or Parquet file")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--format", choices=["csv", "parquet"])
+    export_parser.set_defaults(func=cmd_export)
+
+    import_parser = subparsers.add_parser("import", help="Import accounts from a CSV or Parquet file")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--format", choices=["csv", "parquet"])
+    import_parser.add_argument(
+        "--usernames", action="store_true",
+        help="boxd_username contains Letterboxd usernames to resolve instead of IDs",
+    )
+    import_parser.add_argument(
+        "--verify", action="store_true",
+        help="Only import accounts with their Slack ID in their Letterboxd bio",
+    )
+    import_parser.add_argument(
+        "--backfill", type=int, metavar="DAYS",
+        help="Post the last DAYS of activity in the imported accounts' channels",
+    )
+    import_parser.add_argument(
+        "--workers", type=int, default=8,
+        help="Number of concurrent Letterboxd requests (default: 8)",
+    )
+    import_parser.set_defaults(func=cmd_import)
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="Run a poll against archived Letterboxd responses instead of the API"
+    )
+    replay_parser.add_argument(
+        "archive", help="BOXD_ARCHIVE_PATH used by the bot, or a single archive file"
+    )
+    replay_parser.add_argument(
+        "--days", type=int, default=7,
+        help="Replay archived activities from the last DAYS (default: 7)",
+    )
+    replay_parser.add_argument(
+        "--database", default=os.getenv("DATABASE_PATH", "database.db"),
+        help="Database whose accounts are replayed, a temporary copy is used (default: DATABASE_PATH)",
+    )
+    replay_parser.set_defaults(func=cmd_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,801 @@
+"""
+DuckDB storage for linked accounts and their Letterboxd history
+
+Accounts are kept in memory so that commands and the poller don't have to
+open the database for reads, every write refreshes the cached row.
+"""
+
+import json
+# Not deferred like the other heavy imports: init_db() needs it before the
+# bot can answer any command, so it is always loaded at startup anyway
+import duckdb
+from os import getenv
+from schemas import AbstractActivity, DiaryEntryActivity, WatchlistActivity, FollowActivity, Film
+from threading import Lock
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = getenv("DATABASE_PATH", "database.db")
+
+
+class Account:
+    """
+    A Slack user linked to a Letterboxd member
+    """
+    def __init__(self, slack_id, boxd_id, channel, last_update, events, digests=None):
+        self.slack_id: str = slack_id
+        self.boxd_id: str = boxd_id
+        self.channel: str = channel
+        self.last_update = last_update
+        self.events: list[str] = list(events or [])
+        # Event type -> digest period, events without one are posted right away
+        self.digests: dict[str, str] = dict(digests or [])
+
+
+_accounts: dict[str, Account] = {}
+_accounts_lock = Lock()
+# Rows refreshed while load_accounts runs, one dict per running load
+_loads: list[dict[str, tuple | None]] = []
+
+_ACCOUNT_COLUMNS = """slack_id, boxd_username, channel, lastUpdate, events,
+    (SELECT list([event_type, period]) FROM digests WHERE digests.slack_id = accounts.slack_id)"""
+
+DIGEST_PERIODS = {"hourly": "1 hour", "daily": "1 day"}
+
+
+def init_db():
+    with duckdb.connect(DB_PATH) as conn:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS accounts (
+                slack_id TEXT PRIMARY KEY,
+                boxd_username TEXT UNIQUE NOT NULL,
+                channel TEXT UNIQUE DEFAULT NULL,
+                lastUpdate TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                events VARCHAR[] DEFAULT ['WatchlistActivity', 'DiaryEntryActivity']
+            )"""
+        )
+
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS activities (
+                id TEXT PRIMARY KEY,
+                boxd_id TEXT NOT NULL,
+                type TEXT NOT NULL,
+                when_created TIMESTAMP WITH TIME ZONE NOT NULL,
+                film_id TEXT,
+                film_name TEXT,
+                release_year INTEGER,
+                genres VARCHAR[],
+                rating DOUBLE,
+                liked BOOLEAN,
+                has_review BOOLEAN
+            )"""
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS watchlist (
+                boxd_id TEXT NOT NULL,
+                film_id TEXT NOT NULL,
+                film_name TEXT NOT NULL,
+                url TEXT,
+                rating DOUBLE,
+                PRIMARY KEY (boxd_id, film_id)
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS watchlist_film ON watchlist (film_id)")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS films (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                full_display_name TEXT,
+                release_year INTEGER,
+                runtime INTEGER,
+                rating DOUBLE,
+                adult BOOLEAN,
+                genres VARCHAR[],
+                payload JSON NOT NULL,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            )"""
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS posts (
+                channel TEXT NOT NULL,
+                ts TEXT NOT NULL,
+                slack_id TEXT NOT NULL,
+                activity_id TEXT,
+                posted_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (channel, ts)
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS posts_slack_id ON posts (slack_id)")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS digests (
+                slack_id TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                period TEXT NOT NULL,
+                PRIMARY KEY (slack_id, event_type)
+            )"""
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS digest_buffer (
+                slack_id TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                buffered_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                text TEXT NOT NULL
+            )"""
+        )
+
+    load_accounts()
+
+
+def load_accounts():
+    """Load every account in the cache, replacing its content"""
+    refreshed = {}
+    with _accounts_lock:
+        _loads.append(refreshed)
+
+    try:
+        with duckdb.connect(DB_PATH) as conn:
+            rows = conn.execute(f"SELECT {_ACCOUNT_COLUMNS} FROM accounts").fetchall()
+    finally:
+        with _accounts_lock:
+            _loads.remove(refreshed)
+
+    accounts = {row[0]: Account(*row) for row in rows}
+
+    # Swapped in one go, so readers never see a partially loaded cache
+    global _accounts
+    with _accounts_lock:
+        # Writes committed after the SELECT would be overwritten by the snapshot
+        for slack_id, row in refreshed.items():
+            if row is None:
+                accounts.pop(slack_id, None)
+            else:
+                accounts[slack_id] = Account(*row)
+        _accounts = accounts
+
+
+def _refresh_account(con, slack_id):
+    """Reload one account in the cache after it was written"""
+    row = con.execute(
+        f"SELECT {_ACCOUNT_COLUMNS} FROM accounts WHERE slack_id = ?", [slack_id]
+    ).fetchone()
+
+    with _accounts_lock:
+        if row is None:
+            _accounts.pop(slack_id, None)
+        else:
+            _accounts[slack_id] = Account(*row)
+
+        for refreshed in _loads:
+            refreshed[slack_id] = row
+
+
+def get_boxd_by_slack(slack_id: str):
+    user = get_user(slack_id)
+    return user.boxd_id if user else None
+
+
+def get_user(slack_id: str) -> Account | None:
+    return _accounts.get(slack_id)
+
+
+def link_account(slack_id: str, boxd_username: str):
+    with duckdb.connect(DB_PATH) as con:
+        # First, try to delete existing link if user is re-linking
+        con.execute("DELETE FROM accounts WHERE slack_id = ?", [slack_id])
+        _refresh_account(con, slack_id)
+
+        # Now insert the new link
+        con.execute(
+            "INSERT INTO accounts (slack_id, boxd_username) VALUES (?, ?)",
+            [slack_id, boxd_username],
+        )
+        _refresh_account(con, slack_id)
+
+
+def update_events_subscribe(events, slackid):
+    with duckdb.connect(DB_PATH) as con:
+        con.execute(
+            "UPDATE accounts SET events=? WHERE slack_id=?", [events, slackid]
+        )
+        _refresh_account(con, slackid)
+
+
+def set_digest(slack_id, event_type, period):
+    """
+    Change how often an event type is sent to someone
+
+    :param period: hourly or daily, None to post each activity right away
+    """
+    with duckdb.connect(DB_PATH) as con:
+        con.execute(
+            "DELETE FROM digests WHERE slack_id = ? AND event_type = ?",
+            [slack_id, event_type],
+        )
+        if period is not None:
+            con.execute(
+                "INSERT INTO digests VALUES (?, ?, ?)", [slack_id, event_type, period]
+            )
+        _refresh_account(con, slack_id)
+
+
+def buffer_digest(messages: list[tuple[str, str, str]]):
+    """
+    Keep messages to send later in a digest
+
+    :param messages: (slack_id, event_type, text) of each message
+    """
+    if len(messages) == 0:
+        return
+
+    with duckdb.connect(DB_PATH) as con:
+        con.executemany(
+            "INSERT INTO digest_buffer (slack_id, event_type, text) VALUES (?, ?, ?)",
+            messages,
+        )
+
+
+def get_due_digests() -> list[tuple[str, str, list[str], object]]:
+    """
+    Find buffered messages whose oldest one is older than their digest period
+
+    Messages are returned even if the digest was turned off since they were buffered.
+
+    :return: (slack_id, event_type, texts, last buffered_at) for each digest to send
+    :rtype: list[tuple[str, str, list[str], datetime]]
+    """
+    periods = " ".join(
+        f"WHEN '{name}' THEN INTERVAL '{interval}'" for name, interval in DIGEST_PERIODS.items()
+    )
+
+    with duckdb.connect(DB_PATH) as con:
+        return con.execute(
+            f"""SELECT b.slack_id, b.event_type, list(b.text ORDER BY b.buffered_at), max(b.buffered_at)
+            FROM digest_buffer b
+            LEFT JOIN digests d ON d.slack_id = b.slack_id AND d.event_type = b.event_type
+            GROUP BY b.slack_id, b.event_type, d.period
+            HAVING d.period IS NULL
+                OR min(b.buffered_at) <= now() - CASE d.period {periods} END"""
+        ).fetchall()
+
+
+def delete_digest(slack_id, event_type, until):
+    """
+    Remove the buffered messages of a digest once it was sent
+
+    :param until: Last buffered_at included in the digest, newer messages are kept
+    """
+    with duckdb.connect(DB_PATH) as con:
+        con.execute(
+            "DELETE FROM digest_buffer WHERE slack_id = ? AND event_type = ? AND buffered_at <= ?",
+            [slack_id, event_type, until],
+        )
+
+
+def get_users() -> list[Account]:
+    with _accounts_lock:
+        return list(_accounts.values())
+
+
+def get_configured_users() -> list[Account]:
+    with _accounts_lock:
+        return [user for user in _accounts.values() if user.channel is not None]
+
+
+def get_channel(slack_id):
+    user = get_user(slack_id)
+    return user.channel if user else None
+
+
+def set_channel(slack_id, channel):
+    with duckdb.connect(DB_PATH) as con:
+        con.execute(
+            "UPDATE accounts SET channel=? WHERE slack_id=?", [channel, slack_id]
+        )
+        _refresh_account(con, slack_id)
+
+
+def update_lastUpdate(slack_id):
+    with duckdb.connect(DB_PATH) as con:
+        con.execute(
+            "UPDATE accounts SET lastUpdate = now() WHERE slack_id=?",
+            [slack_id],
+        )
+        _refresh_account(con, slack_id)
+
+
+DEFAULT_EVENTS = ["WatchlistActivity", "DiaryEntryActivity"]
+
+
+def _file_format(path, fmt=None):
+    """Guess the file format (csv or parquet) from its extension"""
+    if fmt is not None:
+        return fmt
+
+    return "parquet" if path.endswith(".parquet") else "csv"
+
+
+def _quote(path):
+    """Quote a path to use it as a string literal in a query"""
+    return "'" + path.replace("'", "''") + "'"
+
+
+def export_accounts(path, fmt=None):
+    """
+    Write every account to a CSV or Parquet file
+
+    :param path: Destination file
+    :param fmt: csv or parquet, guessed from the extension by default
+    """
+    fmt = _file_format(path, fmt)
+    header = ", HEADER" if fmt == "csv" else ""
+
+    with duckdb.connect(DB_PATH) as con:
+        con.execute(
+            f"""COPY (
+                SELECT slack_id, boxd_username, channel, lastUpdate, events,
+                    (SELECT list(event_type || ':' || period ORDER BY event_type)
+                    FROM digests WHERE digests.slack_id = accounts.slack_id) AS digests
+                FROM accounts
+            ) TO {_quote(path)} (FORMAT {fmt}{header})"""
+        )
+
+
+def read_accounts_file(path, fmt=None) -> list[dict]:
+    """
+    Read accounts from a CSV or Parquet file
+
+    The file needs a slack_id and a boxd_username column, channel, lastUpdate,
+    events and digests are optional.
+
+    :param path: Source file
+    :param fmt: csv or parquet, guessed from the extension by default
+    :return: One dict per row
+    :rtype: list[dict]
+    """
+    fmt = _file_format(path, fmt)
+    reader = "read_parquet" if fmt == "parquet" else "read_csv_auto"
+
+    with duckdb.connect() as con:
+        cursor = con.execute(f"SELECT * FROM {reader}({_quote(path)})")
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+
+    for required in ("slack_id", "boxd_username"):
+        if required not in columns:
+            raise ValueError(f"Missing column {required} in {path}")
+
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _parse_list(value):
+    """Read a list column, written as "[a, b]" in CSV files"""
+    if isinstance(value, str):
+        return [item.strip(" '\"") for item in value.strip("[]").split(",") if item.strip()]
+
+    return value
+
+
+def _insert_account(con, slack_id, boxd_id, channel, last_update, events):
+    # Accounts without a lastUpdate start from now, like linked ones
+    con.execute(
+        """INSERT INTO accounts (slack_id, boxd_username, channel, lastUpdate, events)
+        VALUES (?, ?, ?, coalesce(CAST(? AS TIMESTAMP WITH TIME ZONE), now()), ?)""",
+        [slack_id, boxd_id, channel, last_update, events],
+    )
+
+
+def _replace_digests(con, slack_id, digests):
+    """
+    :param digests: "event_type:period" of each digest
+    """
+    con.execute("DELETE FROM digests WHERE slack_id = ?", [slack_id])
+    for digest in digests:
+        event_type, period = digest.split(":", 1)
+        con.execute("INSERT INTO digests VALUES (?, ?, ?)", [slack_id, event_type, period])
+
+
+def import_accounts(accounts: list[dict]):
+    """
+    Insert or replace accounts in bulk
+
+    :param accounts: Rows with slack_id, boxd_username and optionally channel,
+        lastUpdate, events and digests
+    :return: Rows that couldn't be inserted, with the reason
+    :rtype: list[tuple[dict, str]]
+    """
+    failed = []
+
+    with duckdb.connect(DB_PATH) as con:
+        for account in accounts:
+            events = _parse_list(account.get("events"))
+
+            # Like link_account, re-imported users are replaced
+            previous = get_user(account["slack_id"])
+            con.execute("DELETE FROM accounts WHERE slack_id = ?", [account["slack_id"]])
+
+            try:
+                _insert_account(
+                    con, account["slack_id"], account["boxd_username"],
+                    account.get("channel"), account.get("lastUpdate"), events or DEFAULT_EVENTS,
+                )
+            except duckdb.ConstraintException as e:
+                if previous is not None:
+                    _insert_account(
+                        con, previous.slack_id, previous.boxd_id,
+                        previous.channel, previous.last_update, previous.events,
+                    )
+                failed.append((account, str(e)))
+                continue
+
+            # Files without the column keep the current digest settings
+            if "digests" in account:
+                _replace_digests(con, account["slack_id"], _parse_list(account["digests"]) or [])
+
+    load_accounts()
+    return failed
+
+
+def activity_id(activity: AbstractActivity) -> str:
+    """Get a stable ID for an activity, only diary entries have one in the API"""
+    if isinstance(activity, DiaryEntryActivity):
+        return activity.id
+    elif isinstance(activity, FollowActivity):
+        return f"{activity.member.id}:follow:{activity.followed.id}"
+    else:
+        return f"{activity.member.id}:watchlist:{activity.film.id}"
+
+
+def _activity_row(activity: AbstractActivity):
+    """Flatten an activity into a row of the activities table"""
+    film = getattr(activity, "film", None)
+    rating = liked = has_review = None
+
+    if isinstance(activity, DiaryEntryActivity):
+        rating = activity.rating
+        liked = activity.like
+        has_review = activity.review is not None
+
+    return [
+        activity_id(activity),
+        activity.member.id,
+        activity.type,
+        activity.when_created,
+        film.id if film else None,
+        (film.full_display_name or film.name) if film else None,
+        film.release_year if film else None,
+        [genre.name for genre in film.genres] if film else None,
+        rating,
+        liked,
+        has_review,
+    ]
+
+
+def record_activities(activities: list[AbstractActivity]):
+    """
+    Append activities to the history in a single transaction, already known ones are ignored
+
+    :param activities: Activities fetched during a poll
+    :type activities: list[AbstractActivity]
+    """
+    if len(activities) == 0:
+        return
+
+    added = [
+        _watchlist_row(activity.member.id, activity.film)
+        for activity in activities if isinstance(activity, WatchlistActivity)
+    ]
+    # Letterboxd removes logged films from the watchlist
+    watched = [
+        [activity.member.id, activity.film.id]
+        for activity in activities if isinstance(activity, DiaryEntryActivity)
+    ]
+
+    films = [activity.film for activity in activities if hasattr(activity, "film")]
+
+    with duckdb.connect(DB_PATH) as con:
+        con.executemany(
+            "INSERT OR IGNORE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [_activity_row(activity) for activity in activities],
+        )
+        _upsert_films(con, films)
+        if added:
+            con.executemany("INSERT OR IGNORE INTO watchlist VALUES (?, ?, ?, ?, ?)", added)
+        if watched:
+            con.executemany("DELETE FROM watchlist WHERE boxd_id = ? AND film_id = ?", watched)
+
+
+def get_ratings_distribution(boxd_id):
+    """
+    :return: (rating, count) for every rating given in the diary
+    :rtype: list[tuple[float, int]]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        return con.execute(
+            """SELECT rating, count(*) FROM activities
+            WHERE boxd_id = ? AND type = 'DiaryEntryActivity' AND rating IS NOT NULL
+            GROUP BY rating ORDER BY rating DESC""",
+            [boxd_id],
+        ).fetchall()
+
+
+def get_top_genres(boxd_id, limit=5):
+    """
+    :return: (genre, count) for the most logged genres
+    :rtype: list[tuple[str, int]]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        return con.execute(
+            """SELECT genre, count(*) AS films FROM (
+                SELECT unnest(genres) AS genre FROM activities
+                WHERE boxd_id = ? AND type = 'DiaryEntryActivity'
+            )
+            GROUP BY genre ORDER BY films DESC, genre LIMIT ?""",
+            [boxd_id, limit],
+        ).fetchall()
+
+
+def get_films_per_month(boxd_id, months=6):
+    """
+    :return: (month, count) of logged films for the last months, most recent first
+    :rtype: list[tuple[str, int]]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        return con.execute(
+            """SELECT strftime(date_trunc('month', when_created), '%Y-%m') AS month, count(*)
+            FROM activities
+            WHERE boxd_id = ? AND type = 'DiaryEntryActivity'
+            GROUP BY month ORDER BY month DESC LIMIT ?""",
+            [boxd_id, months],
+        ).fetchall()
+
+
+def _film_payload(film: Film):
+    """Rebuild the API payload of a film, so it can be parsed again by Film"""
+    payload = {
+        "id": film.id,
+        "name": film.name,
+        "sortingName": film.sorting_name,
+        "fullDisplayName": film.full_display_name,
+        "releaseYear": film.release_year,
+        "runTime": film.runtime,
+        "rating": film.rating,
+        "adult": film.adult,
+        "links": [
+            {"type": link.type.value, "id": link.id, "url": link.url, "label": link.label, "checkUrl": link.check_url}
+            for link in film.links.values()
+        ],
+        "genres": [{"id": genre.id, "name": genre.name} for genre in film.genres],
+        "description": film.description,
+        "tagline": film.tagline,
+    }
+    if film.poster is not None:
+        payload["poster"] = {
+            "sizes": [
+                {"width": size.width, "height": size.height, "url": size.url}
+                for size in film.poster.sizes
+            ]
+        }
+
+    return {key: value for key, value in payload.items() if value is not None}
+
+
+def _upsert_films(con, films: list[Film]):
+    """Add or update films in the catalogue, keeping known ratings missing from summaries"""
+    films = list({film.id: film for film in films}.values())
+    if len(films) == 0:
+        return
+
+    con.executemany(
+        """INSERT INTO films VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, now())
+        ON CONFLICT (id) DO UPDATE SET
+            name = excluded.name,
+            full_display_name = excluded.full_display_name,
+            release_year = excluded.release_year,
+            runtime = coalesce(excluded.runtime, films.runtime),
+            rating = coalesce(excluded.rating, films.rating),
+            adult = excluded.adult,
+            genres = excluded.genres,
+            -- Summaries have no runtime or rating, keep the ones already known
+            payload = json_merge_patch(films.payload, excluded.payload),
+            updated_at = excluded.updated_at""",
+        [
+            [
+                film.id,
+                film.name,
+                film.full_display_name,
+                film.release_year,
+                film.runtime,
+                film.rating,
+                film.adult,
+                [genre.name for genre in film.genres],
+                json.dumps(_film_payload(film)),
+            ]
+            for film in films
+        ],
+    )
+
+
+def upsert_films(films: list[Film]):
+    """
+    Add or update films in the catalogue
+
+    :param films: Films seen in any API payload
+    :type films: list[Film]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        _upsert_films(con, films)
+
+
+def get_stale_film_ids(max_age_days=7, limit=1000) -> list[str]:
+    """
+    :return: IDs of the films least recently updated, older than max_age_days
+    :rtype: list[str]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        rows = con.execute(
+            """SELECT id FROM films
+            WHERE updated_at < now() - to_days(CAST(? AS INTEGER))
+            ORDER BY updated_at LIMIT ?""",
+            [max_age_days, limit],
+        ).fetchall()
+
+    return [row[0] for row in rows]
+
+
+def get_unrated_film_ids(limit=200) -> list[str]:
+    """
+    :return: IDs of watchlisted films without a rating, least recently updated first
+    :rtype: list[str]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        rows = con.execute(
+            """SELECT id FROM films
+            WHERE rating IS NULL AND id IN (SELECT film_id FROM watchlist)
+            ORDER BY updated_at LIMIT ?""",
+            [limit],
+        ).fetchall()
+
+    return [row[0] for row in rows]
+
+
+def pick_watchlist_film(boxd_id) -> Film | None:
+    """
+    Pick a random catalogued film from a member's indexed watchlist
+
+    :return: The film, None if the watchlist isn't indexed yet
+    :rtype: Film or None
+    """
+    with duckdb.connect(DB_PATH) as con:
+        row = con.execute(
+            """SELECT f.payload FROM watchlist w JOIN films f ON f.id = w.film_id
+            WHERE w.boxd_id = ? ORDER BY random() LIMIT 1""",
+            [boxd_id],
+        ).fetchone()
+
+    return Film(json.loads(row[0])) if row else None
+
+
+def _watchlist_row(boxd_id, film: Film):
+    letterboxd = film.links.get("letterboxd")
+    return [
+        boxd_id,
+        film.id,
+        film.full_display_name or film.name,
+        letterboxd.url if letterboxd else None,
+        film.rating,
+    ]
+
+
+def replace_watchlist(boxd_id, films: list[Film]):
+    """
+    Replace the indexed watchlist of a member
+
+    :param boxd_id: The Letterboxd member ID
+    :param films: Every film currently in their watchlist
+    :type films: list[Film]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        _upsert_films(con, films)
+        con.execute(
+            "DELETE FROM watchlist WHERE boxd_id = ? AND NOT list_contains(?, film_id)",
+            [boxd_id, [film.id for film in films]],
+        )
+        if films:
+            con.executemany(
+                "INSERT OR REPLACE INTO watchlist VALUES (?, ?, ?, ?, ?)",
+                [_watchlist_row(boxd_id, film) for film in films],
+            )
+
+
+def get_indexed_watchlists(boxd_ids: list[str]) -> set[str]:
+    """
+    :return: Member IDs that have at least one film in the indexed watchlist
+    :rtype: set[str]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        rows = con.execute(
+            "SELECT DISTINCT boxd_id FROM watchlist WHERE boxd_id IN (SELECT unnest(?))",
+            [boxd_ids],
+        ).fetchall()
+
+    return {row[0] for row in rows}
+
+
+def get_watchlist_overlap(boxd_ids: list[str], limit=10, ranked=False):
+    """
+    Find films in the watchlist of every member
+
+    :param boxd_ids: Letterboxd member IDs
+    :param limit: Maximum number of films
+    :param ranked: Sort by Letterboxd rating instead of picking randomly
+    :return: (film_id, film_name, url, rating) in every watchlist
+    :rtype: list[tuple[str, str, str, float]]
+    """
+    order = "rating DESC NULLS LAST" if ranked else "random()"
+
+    # Watchlist rows come from summaries, the rating is in the film catalogue
+    with duckdb.connect(DB_PATH) as con:
+        return con.execute(
+            f"""SELECT w.film_id, any_value(w.film_name), any_value(w.url),
+                coalesce(any_value(f.rating), any_value(w.rating)) AS rating
+            FROM watchlist w LEFT JOIN films f ON f.id = w.film_id
+            WHERE w.boxd_id IN (SELECT unnest(?))
+            GROUP BY w.film_id HAVING count(*) = ?
+            ORDER BY {order} LIMIT ?""",
+            [boxd_ids, len(set(boxd_ids)), limit],
+        ).fetchall()
+
+
+def record_posts(posts: list[tuple[str, str, str, str | None]]):
+    """
+    Register messages posted by the bot
+
+    :param posts: (channel, ts, slack_id, activity_id) of each message, activity_id is None for digests
+    """
+    if len(posts) == 0:
+        return
+
+    with duckdb.connect(DB_PATH) as con:
+        con.executemany(
+            "INSERT OR IGNORE INTO posts (channel, ts, slack_id, activity_id) VALUES (?, ?, ?, ?)",
+            posts,
+        )
+
+
+def get_post_author(channel, ts) -> str | None:
+    """
+    :return: Slack ID of the user a message was posted for, None if it isn't registered
+    :rtype: str or None
+    """
+    with duckdb.connect(DB_PATH) as con:
+        row = con.execute(
+            "SELECT slack_id FROM posts WHERE channel = ? AND ts = ?", [channel, ts]
+        ).fetchone()
+
+    return row[0] if row else None
+
+
+def get_user_posts(slack_id) -> list[tuple[str, str]]:
+    """
+    :return: (channel, ts) of every message posted for a user, oldest first
+    :rtype: list[tuple[str, str]]
+    """
+    with duckdb.connect(DB_PATH) as con:
+        return con.execute(
+            "SELECT channel, ts FROM posts WHERE slack_id = ? ORDER BY posted_at",
+            [slack_id],
+        ).fetchall()
+
+
+def delete_posts(posts: list[tuple[str, str]]):
+    """
+    Remove messages from the registry
+
+    :param posts: (channel, ts) of each deleted message
+    """
+    if len(posts) == 0:
+        return
+
+    with duckdb.connect(DB_PATH) as con:
+        con.executemany("DELETE FROM posts WHERE channel = ? AND ts = ?", posts)
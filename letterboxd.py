@@ -3,8 +3,20 @@ Letterboxd API client for interacting with the Letterboxd API.
 
 Provides OAuth2-authenticated access to Letterboxd member data, including
 activity feeds, member search, and profile information.
+
+Raw responses can be archived in gzip-compressed JSON lines files, one per
+process, and replayed later with ArchiveReplayClient without calling the API.
 """
 
+import os
+import glob
+import gzip
+import json
+import zlib
+import ijson
+from datetime import datetime, timezone
+from threading import Lock
+from requests import HTTPError
 from authlib.integrations.requests_client import OAuth2Session
 from schemas import (
     AbstractActivity,
@@ -28,6 +40,8 @@ class LetterboxdClient:
         client_secret,
         username,
         password,
+        archive_path=None,
+        baseurl=None,
     ):
         """
         Initialize the Letterboxd API client with OAuth2 credentials.
@@ -36,8 +50,10 @@ class LetterboxdClient:
         :param client_secret: OAuth2 client secret from Letterboxd API application
         :param username: Letterboxd account username for authentication
         :param password: Letterboxd account password for authentication
+        :param archive_path: Archive every raw response in gzip JSON lines files named after this path
+        :param baseurl: API URL, defaults to the official Letterboxd API
         """
-        self.baseurl = self.DEFAULT_BASEURL
+        self.baseurl = baseurl or self.DEFAULT_BASEURL
 
         self.oauth = OAuth2Session(
             client_id=client_id,
@@ -45,12 +61,91 @@ class LetterboxdClient:
             token_endpoint=f"{self.baseurl}/auth/token",
         )
 
-        self.token = self.oauth.fetch_token(
-            url=f"{self.baseurl}/auth/token",
-            grant_type="password",
-            username=username,
-            password=password,
-        )
+        # The token is fetched on the first request so that creating the
+        # client doesn't block on the network
+        self.token = None
+        self._username = username
+        self._password = password
+        self._login_lock = Lock()
+
+        self._archive = None
+        self._archive_lock = Lock()
+        if archive_path:
+            # Never truncates the file of another client
+            self._archive = gzip.open(_process_archive_path(archive_path), "xt")
+
+    def close(self):
+        """
+        Close the archive, writing the gzip trailer.
+        """
+        with self._archive_lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+
+    def login(self):
+        """
+        Fetch an OAuth2 token using the password grant, if not already done.
+
+        :return: The OAuth2 token
+        :rtype: dict
+        """
+        with self._login_lock:
+            if self.token is None:
+                self.token = self.oauth.fetch_token(
+                    url=f"{self.baseurl}/auth/token",
+                    grant_type="password",
+                    username=self._username,
+                    password=self._password,
+                )
+
+        return self.token
+
+    def _get(self, path, **kwargs):
+        """
+        Send an authenticated GET request to the API, logging in if needed.
+
+        :param path: Path relative to the API base URL
+        :return: The HTTP response
+        """
+        if self.token is None:
+            self.login()
+
+        resp = self.oauth.get(f"{self.baseurl}{path}", **kwargs)
+
+        if self._archive is not None:
+            self._archive_response(path, kwargs.get("params"), resp)
+
+        return resp
+
+    def _archive_response(self, path, params, resp):
+        """
+        Append a raw response to the archive.
+
+        :param path: Requested path relative to the API base URL
+        :param params: Query parameters of the request
+        :param resp: The HTTP response
+        """
+        try:
+            body = resp.json()
+        except ValueError:
+            body = resp.text
+
+        record = {
+            "when": datetime.now(timezone.utc).isoformat(),
+            "path": path,
+            "params": params,
+            "status": resp.status_code,
+            "body": body,
+        }
+
+        with self._archive_lock:
+            if self._archive is None:
+                return
+
+            self._archive.write(json.dumps(record) + "\n")
+            # Keep what was written readable if the process is killed
+            self._archive.flush()
 
     def get_id_by_username(self, username):
         """
@@ -60,8 +155,8 @@ class LetterboxdClient:
         :return: Member ID if found, None otherwise
         :rtype: str or None
         """
-        resp = self.oauth.get(
-            f"{self.baseurl}/search",
+        resp = self._get(
+            "/search",
             params={
                 "input": username,
                 "include": "MemberSearchItem",
@@ -90,54 +185,269 @@ class LetterboxdClient:
         :return: Member data including profile information
         :rtype: dict
         """
-        resp = self.oauth.get(f"{self.baseurl}/member/{boxd_id}")
+        resp = self._get(f"/member/{boxd_id}")
         resp.raise_for_status()
 
         return resp.json()
 
-    def get_activity(self, boxd_id) -> list[AbstractActivity]:
+    def _iter_items(self, path, params):
         """
-        Fetch the activity feed for a member.
+        Yield the items of a page while its body is being downloaded.
+
+        :param path: Path relative to the API base URL
+        :param params: Query parameters of the request
+        :return: Raw items, parsed one by one
+        """
+        if self._archive is not None:
+            # The archive needs the whole body
+            resp = self._get(path, params=params)
+            resp.raise_for_status()
+            yield from resp.json()["items"]
+            return
+
+        with self._get(path, params=params, stream=True) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            yield from ijson.items(resp.raw, "items.item", use_float=True)
+
+    def iter_activity(self, boxd_id, since=None):
+        """
+        Stream the activity feed for a member, most recent first.
+
+        Activities are parsed as they are downloaded, and the download stops
+        at the first activity older than ``since``.
 
         :param boxd_id: The Letterboxd member ID
-        :return: List of activity objects
-        :rtype: list[AbstractActivity]
+        :param since: Stop at activities created before this date
+        :type since: datetime
+        :return: Generator of activity objects
+        :rtype: Iterator[AbstractActivity]
         """
-        resp = self.oauth.get(
-            f"{self.baseurl}/member/{boxd_id}/activity",
+        items = self._iter_items(
+            f"/member/{boxd_id}/activity",
             params={"perPage": 100, "adult": False, "where": "OwnActivity"},
         )
-        resp.raise_for_status()
 
-        data = resp.json()
-
-        _activities = []
-        for item in data["items"]:
+        for item in items:
+            activity = None
             if item["type"] == "WatchlistActivity":
-                _activities.append(WatchlistActivity(**item))
+                activity = WatchlistActivity(**item)
             elif item["type"] == "DiaryEntryActivity":
-                _activities.append(DiaryEntryActivity(**item))
+                activity = DiaryEntryActivity(**item)
             elif item["type"] == "FollowActivity":
-                _activities.append(FollowActivity(**item))
+                activity = FollowActivity(**item)
 
-        return _activities
+            if activity is None:
+                continue
+
+            if since is not None and activity.when_created < since:
+                items.close()
+                return
+
+            yield activity
+
+    def get_activity(self, boxd_id) -> list[AbstractActivity]:
+        """
+        Fetch the activity feed for a member.
+
+        :param boxd_id: The Letterboxd member ID
+        :return: List of activity objects
+        :rtype: list[AbstractActivity]
+        """
+        return list(self.iter_activity(boxd_id))
 
     def get_watchlist(self, boxd_id):
-        resp = self.oauth.get(
-            f"{self.baseurl}/member/{boxd_id}/watchlist", params={"perPage": 100}
+        resp = self._get(
+            f"/member/{boxd_id}/watchlist", params={"perPage": 100}
         )
 
         return [film['id'] for film in resp.json()["items"]]
 
 
+    def get_watchlist_films(self, boxd_id) -> list[Film]:
+        """
+        Fetch every film in a member's watchlist, following the pagination.
+
+        :param boxd_id: The Letterboxd member ID
+        :return: Films in the watchlist
+        :rtype: list[Film]
+        """
+        films = []
+        cursor = None
+
+        while True:
+            params = {"perPage": 100}
+            if cursor is not None:
+                params["cursor"] = cursor
+
+            resp = self._get(f"/member/{boxd_id}/watchlist", params=params)
+            resp.raise_for_status()
+
+            data = resp.json()
+            films += [Film(film) for film in data["items"]]
+
+            cursor = data.get("next")
+            if cursor is None or len(data["items"]) == 0:
+                return films
+
+    def get_films(self, film_ids) -> list[Film]:
+        """
+        Fetch many films at once, by batches of 100.
+
+        :param film_ids: Letterboxd film IDs
+        :return: The films found
+        :rtype: list[Film]
+        """
+        film_ids = list(film_ids)
+        films = []
+
+        for i in range(0, len(film_ids), 100):
+            batch = film_ids[i:i + 100]
+            resp = self._get(
+                "/films", params={"filmId": batch, "perPage": len(batch)}
+            )
+            resp.raise_for_status()
+
+            films += [Film(film) for film in resp.json()["items"]]
+
+        return films
+
     def get_film(self, film_id):
-        resp = self.oauth.get(
-            f"{self.baseurl}/film/{film_id}"
+        resp = self._get(
+            f"/film/{film_id}"
         )
         
         return Film(resp.json())
 
 
+def _split_archive_path(archive_path):
+    """Split letterboxd.jsonl.gz into (letterboxd, .jsonl.gz)"""
+    directory, name = os.path.split(archive_path)
+    stem, dot, extension = name.partition(".")
+    return os.path.join(directory, stem), dot + (extension or "jsonl.gz")
+
+
+def _process_archive_path(archive_path):
+    """
+    Get the file written by this process, a gzip file can't be safely
+    appended to after an unclean shutdown so each run gets its own.
+    """
+    stem, extension = _split_archive_path(archive_path)
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    return f"{stem}-{timestamp}-{os.getpid()}{extension}"
+
+
+def archive_files(archive_path):
+    """
+    List the archive files written for an archive path, oldest first.
+
+    :param archive_path: Path given as archive_path, or a single archive file
+    :rtype: list[str]
+    """
+    if os.path.isfile(archive_path):
+        return [archive_path]
+
+    stem, extension = _split_archive_path(archive_path)
+    return sorted(glob.glob(f"{glob.escape(stem)}-*{extension}"))
+
+
+def _read_archive_lines(path):
+    """
+    Yield the complete lines of an archive file.
+
+    Decompression is done by chunks so that a file left without a trailer,
+    or corrupted, still gives every record written before the damage.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b""
+
+    try:
+        with open(path, "rb") as archive:
+            while chunk := archive.read(64 * 1024):
+                while chunk:
+                    pending += decompressor.decompress(chunk)
+                    # A new gzip member starts after the end of the previous one
+                    chunk = decompressor.unused_data if decompressor.eof else b""
+                    if decompressor.eof:
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    yield line.decode()
+    except (OSError, zlib.error):
+        pass
+
+
+def _request_key(path, params):
+    return path, json.dumps(params or {}, sort_keys=True)
+
+
+class _ArchivedResponse:
+    """
+    Minimal stand-in for a requests response, read from the archive
+    """
+    def __init__(self, record):
+        self.status_code = record["status"]
+        self._body = record["body"]
+
+    def json(self):
+        return self._body
+
+    @property
+    def text(self):
+        return self._body if isinstance(self._body, str) else json.dumps(self._body)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(f"{self.status_code} Error (archived)", response=self)
+
+
+class ArchiveReplayClient(LetterboxdClient):
+    """
+    Client answering from an archive made with LetterboxdClient(archive_path=...).
+    """
+
+    def __init__(self, archive_path):
+        """
+        Load an archive, the last response of each request is used.
+
+        :param archive_path: archive_path given to LetterboxdClient, or a single archive file
+        """
+        self.baseurl = self.DEFAULT_BASEURL
+        self.token = {}
+        self._archive = None
+        self._archive_lock = Lock()
+        self._responses = {}
+        self.files = archive_files(archive_path)
+
+        for path in self.files:
+            self._load(path)
+
+    def _load(self, path):
+        for line in _read_archive_lines(path):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            self._responses[_request_key(record["path"], record["params"])] = record
+
+    def login(self):
+        return self.token
+
+    def _iter_items(self, path, params):
+        resp = self._get(path, params=params)
+        resp.raise_for_status()
+        yield from resp.json()["items"]
+
+    def _get(self, path, **kwargs):
+        record = self._responses.get(_request_key(path, kwargs.get("params")))
+        if record is None:
+            return _ArchivedResponse({"status": 404, "body": {}})
+
+        return _ArchivedResponse(record)
+
+
 if __name__ == "__main__":
     from dotenv import load_dotenv
     from os import getenv
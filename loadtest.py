@@ -0,0 +1,302 @@
+"""
+Load test of the activity poller
+
+Seeds synthetic accounts in a temporary database, then runs poller ticks
+against a local fake Letterboxd and Slack API with configurable latency
+and error rate, and reports throughput, tick duration, DB time and memory.
+
+Example:
+    python loadtest.py --accounts 10000 --ticks 3 --latency 0.05 --error-rate 0.01
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import resource
+import itertools
+from threading import Thread, Lock, Event
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeAPI(BaseHTTPRequestHandler):
+    """
+    Answer the Letterboxd and Slack calls made by the poller with synthetic data
+    """
+    latency = 0.0
+    error_rate = 0.0
+    activities = 2
+    counter = itertools.count()
+    calls = {}
+    calls_lock = Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, name):
+        with self.calls_lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path = self.path.split("?")[0]
+        self._count("letterboxd " + path.split("/")[-1])
+
+        if random.random() < self.error_rate:
+            self._send(500, {"error": "fake error"})
+        elif path.startswith("/letterboxd/member/") and path.endswith("/activity"):
+            boxd_id = path.split("/")[-2]
+            items = [self._diary_entry(boxd_id) for _ in range(self.activities)]
+            self._send(200, {"items": items})
+        else:
+            self._send(404, {})
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        self._count(self.path)
+
+        if self.path == "/letterboxd/auth/token":
+            self._send(200, {"access_token": "loadtest", "token_type": "bearer", "expires_in": 86400})
+        elif self.path == "/slack/auth.test":
+            self._send(200, {"ok": True, "user_id": "U0", "bot_id": "B0", "team_id": "T0", "url": "https://loadtest.slack.com/"})
+        elif random.random() < self.error_rate:
+            self._send(200, {"ok": False, "error": "internal_error"})
+        elif self.path == "/slack/chat.postMessage":
+            channel = json.loads(body or b"{}").get("channel", "C0")
+            self._send(200, {"ok": True, "channel": channel, "ts": f"{time.time():.6f}"})
+        else:
+            self._send(200, {"ok": True})
+
+    def _diary_entry(self, boxd_id):
+        n = next(self.counter)
+        return {
+            "type": "DiaryEntryActivity",
+            "whenCreated": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            "member": {
+                "id": boxd_id,
+                "username": f"user_{boxd_id}",
+                "displayName": f"User {boxd_id}",
+                "shortName": f"User {boxd_id}",
+                "pronoun": {
+                    "id": "they", "label": "They", "subjectPronoun": "they",
+                    "objectPronoun": "them", "possessiveAdjective": "their",
+                    "possessivePronoun": "theirs", "reflexive": "themselves",
+                },
+                "avatar": {"sizes": []},
+                "memberStatus": "Member",
+                "accountStatus": "Active",
+            },
+            "diaryEntry": {
+                "id": f"entry{n}",
+                "name": f"Film {n % 500}",
+                "rating": random.choice([1, 2, 2.5, 3, 3.5, 4, 4.5, 5]),
+                "like": random.random() < 0.3,
+                "film": {
+                    "id": f"film{n % 500}",
+                    "name": f"Film {n % 500}",
+                    "sortingName": f"film-{n % 500}",
+                    "releaseYear": 1950 + n % 75,
+                    "adult": False,
+                    "links": [{"type": "letterboxd", "id": f"film{n % 500}", "url": f"https://letterboxd.com/film/film-{n % 500}/"}],
+                    "genres": [{"id": "g1", "name": random.choice(["Drama", "Comedy", "Horror", "Animation"])}],
+                    "poster": {"sizes": [
+                        {"width": 70, "height": 105, "url": "https://example.com/70.jpg"},
+                        {"width": 230, "height": 345, "url": "https://example.com/230.jpg"},
+                    ]},
+                },
+            },
+        }
+
+
+def seed_accounts(database, count):
+    """Insert synthetic accounts in a single query"""
+    with database.duckdb.connect(database.DB_PATH) as con:
+        con.execute(
+            """INSERT INTO accounts (slack_id, boxd_username, channel, lastUpdate, events)
+            SELECT 'U' || i, 'B' || i, 'C' || i, now() - INTERVAL 1 HOUR,
+                ['WatchlistActivity', 'DiaryEntryActivity', 'FollowActivity']
+            FROM range(?) t(i)""",
+            [count],
+        )
+
+    database.load_accounts()
+
+
+def timed_db(bot, names, timings):
+    """Measure the time spent in the database functions used by the poller"""
+    for name in names:
+        function = getattr(bot, name)
+
+        def wrapper(*args, _function=function, **kwargs):
+            start = time.monotonic()
+            try:
+                return _function(*args, **kwargs)
+            finally:
+                timings.append(time.monotonic() - start)
+
+        setattr(bot, name, wrapper)
+
+
+class RssSampler(Thread):
+    """
+    Sample the resident memory of the process in the background
+
+    Cheaper than tracemalloc, which slows down every allocation of the ticks it measures.
+    """
+    def __init__(self, interval=0.2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = Event()
+
+    @staticmethod
+    def rss():
+        """Current resident memory in bytes, the peak one where /proc isn't available"""
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, self.rss())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the activity poller")
+    parser.add_argument("--accounts", type=int, default=10_000)
+    parser.add_argument("--ticks", type=int, default=3)
+    parser.add_argument("--activities", type=int, default=2, help="New activities per account per tick")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every fake API call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of fake API calls failing")
+    parser.add_argument("--unlimited", action="store_true", help="Poll every account each tick, ignoring load shedding")
+    parser.add_argument("--report", help="Also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    FakeAPI.latency = args.latency
+    FakeAPI.error_rate = args.error_rate
+    FakeAPI.activities = args.activities
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPI)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+        run(args, url, tmpdir.name)
+    finally:
+        server.shutdown()
+        tmpdir.cleanup()
+
+
+def run(args, url, tmpdir):
+    """Seed the accounts and run the ticks, the database lives in tmpdir"""
+    os.environ["DATABASE_PATH"] = os.path.join(tmpdir, "loadtest.db")
+    os.environ["BOXD_API_URL"] = f"{url}/letterboxd"
+    os.environ["SLACK_API_URL"] = f"{url}/slack/"
+    os.environ["SLACK_BOT_TOKEN"] = "xoxb-loadtest"
+    # Empty rather than unset, so .env can't turn the archive on
+    os.environ["BOXD_ARCHIVE_PATH"] = ""
+
+    # Imported after the environment is set, they read it at import time
+    import poller
+    import database
+    import main as bot
+
+    database.init_db()
+    seed_start = time.monotonic()
+    seed_accounts(database, args.accounts)
+    print(f"Seeded {args.accounts} accounts in {time.monotonic() - seed_start:.2f}s")
+
+    db_timings = []
+    timed_db(bot, ["get_configured_users", "record_activities", "record_posts"], db_timings)
+    timed_db(poller, ["buffer_digest", "update_lastUpdate"], db_timings)
+
+    rss_before = RssSampler.rss()
+    sampler = RssSampler()
+    sampler.start()
+    ticks = []
+    for tick in range(args.ticks):
+        if args.unlimited:
+            bot.load_controller.batch_size = args.accounts
+
+        batch_size = bot.load_controller.batch_size
+        workers = bot.load_controller.workers
+        polled = args.accounts if batch_size is None else min(args.accounts, batch_size)
+        db_timings.clear()
+        posts_before = FakeAPI.calls.get("/slack/chat.postMessage", 0)
+
+        start = time.monotonic()
+        bot.post_activities()
+        duration = time.monotonic() - start
+
+        controller = bot.load_controller
+        ticks.append({
+            "tick": tick + 1,
+            "duration": duration,
+            "polled": polled,
+            "posts": FakeAPI.calls.get("/slack/chat.postMessage", 0) - posts_before,
+            "workers": workers,
+            "db_time": sum(db_timings),
+            # Share of the workers' time spent in the database, at most 100%
+            "db_time_share": sum(db_timings) / (workers * duration),
+            "controller": str(controller),
+        })
+        print(
+            f"Tick {tick + 1}: {duration:.2f}s, {ticks[-1]['posts']} posts, "
+            f"DB {ticks[-1]['db_time_share']:.0%} of the workers' time, {controller}"
+        )
+
+    sampler.stop()
+
+    total = sum(tick["duration"] for tick in ticks)
+    report = {
+        "accounts": args.accounts,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "ticks": ticks,
+        "users_per_second": sum(tick["polled"] for tick in ticks) / total,
+        "posts_per_second": sum(tick["posts"] for tick in ticks) / total,
+        "db_time_share": (
+            sum(tick["db_time"] for tick in ticks)
+            / sum(tick["workers"] * tick["duration"] for tick in ticks)
+        ),
+        "rss_before_ticks_mb": rss_before / 1024 / 1024,
+        "peak_rss_mb": sampler.peak / 1024 / 1024,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "api_calls": FakeAPI.calls,
+    }
+
+    print(f"Throughput: {report['users_per_second']:.1f} users/s, {report['posts_per_second']:.1f} posts/s")
+    print(f"DB time share: {report['db_time_share']:.0%} of the workers' time")
+    print(
+        f"Memory: {report['rss_before_ticks_mb']:.1f} MB RSS before the ticks, "
+        f"{report['peak_rss_mb']:.1f} MB peak during them, {report['max_rss_mb']:.1f} MB max RSS"
+    )
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
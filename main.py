@@ -1,108 +1,69 @@
 import re
+import sys
+import time
+import atexit
+import signal
 import blocks
 import duckdb
 import random
+import logging
 from utils import *
+from database import *
 from os import getenv
 from slack_bolt import App
 from dotenv import load_dotenv
 from letterboxd import LetterboxdClient
+from threading import Event, Thread
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from poller import post_user_activities
+from backpressure import LoadController
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from slack_bolt.adapter.socket_mode import SocketModeHandler
-from apscheduler.schedulers.background import BackgroundScheduler
-from schemas import FollowActivity, WatchlistActivity, DiaryEntryActivity
 
 load_dotenv()
 
-app = App()
+logger = logging.getLogger(__name__)
+
+# A custom client is only needed to point at another API, Bolt reads the
+# token from SLACK_BOT_TOKEN otherwise
+slack_client = None
+if getenv("SLACK_API_URL"):
+    slack_client = WebClient(token=getenv("SLACK_BOT_TOKEN"), base_url=getenv("SLACK_API_URL"))
+
+# Listeners run in this pool, so interactions aren't queued behind slow commands
+app = App(
+    client=slack_client,
+    listener_executor=ThreadPoolExecutor(
+        max_workers=int(getenv("SLACK_LISTENER_WORKERS", 20))
+    ),
+)
 boxd_client = LetterboxdClient(
     client_id=getenv("BOXD_CLIENT_ID"),
     client_secret=getenv("BOXD_CLIENT_SECRET"),
     username=getenv("BOXD_USERNAME"),
     password=getenv("BOXD_PASSWORD"),
+    archive_path=getenv("BOXD_ARCHIVE_PATH"),
+    baseurl=getenv("BOXD_API_URL"),
 )
-DB_PATH = getenv("DATABASE_PATH", "database.db")
-
-
-def init_db():
-    with duckdb.connect(DB_PATH) as conn:
-        conn.execute(
-            """CREATE TABLE IF NOT EXISTS accounts (
-                slack_id TEXT PRIMARY KEY,
-                boxd_username TEXT UNIQUE NOT NULL,
-                channel TEXT UNIQUE DEFAULT NULL,
-                lastUpdate TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                events VARCHAR[] DEFAULT ['WatchlistActivity', 'DiaryEntryActivity']
-            )"""
-        )
-
-
-def get_boxd_by_slack(slack_id: str):
-    with duckdb.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT boxd_username FROM accounts WHERE slack_id = ?", [slack_id]
-        ).fetchone()
-        return row[0] if row else None
-
-
-def get_user(slack_id: str):
-    with duckdb.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT * FROM accounts WHERE slack_id = ?", [slack_id]
-        ).fetchone()
-        return row if row else None
-
-def link_account(slack_id: str, boxd_username: str):
-    with duckdb.connect(DB_PATH) as con:
-        # First, try to delete existing link if user is re-linking
-        con.execute("DELETE FROM accounts WHERE slack_id = ?", [slack_id])
-        
-        # Now insert the new link
-        con.execute(
-            "INSERT INTO accounts (slack_id, boxd_username) VALUES (?, ?)",
-            [slack_id, boxd_username],
-        )
-
-def update_events_subscribe(events, slackid):
-    with duckdb.connect(DB_PATH) as con:
-        con.execute(
-            "UPDATE accounts SET events=? WHERE slack_id=?", [events, slackid]
-        )
-
-def get_configured_users():
-    with duckdb.connect(DB_PATH) as conn:
-        rows = conn.execute(
-            "SELECT * FROM accounts WHERE channel IS NOT NULL"
-        ).fetchall()
-        return rows if rows else []
-
-
-def get_channel(slack_id):
-    with duckdb.connect(DB_PATH) as con:
-        row = con.execute(
-            "SELECT channel FROM accounts WHERE slack_id=?", [slack_id]
-        ).fetchone()
-        return row[0] if row else None
 
-
-def set_channel(slack_id, channel):
-    with duckdb.connect(DB_PATH) as con:
-        con.execute(
-            "UPDATE accounts SET channel=? WHERE slack_id=?", [channel, slack_id]
-        )
-
-
-def update_lastUpdate(slack_id):
-    with duckdb.connect(DB_PATH) as con:
-        con.execute(
-            "UPDATE accounts SET lastUpdate = now() WHERE slack_id=?",
-            [slack_id],
-        )
+POLL_INTERVAL = 30 * 60
+load_controller = LoadController(
+    interval=POLL_INTERVAL,
+    max_batch=int(getenv("POLL_MAX_BATCH")) if getenv("POLL_MAX_BATCH") else None,
+    max_workers=int(getenv("POLL_MAX_WORKERS", 8)),
+)
 
 
 BOXD_USERNAME_PATTERN = re.compile(r"^[a-zA-Z0-9_]{2,15}$")
+SLACK_MENTION_PATTERN = re.compile(r"<@([A-Z0-9]+)(?:\|[^>]*)?>")
+# Seconds between two chat.delete calls, it allows about 50 calls per minute
+PURGE_DELAY = 1.2
 
 
 @app.command("/boxd-info")
+@timed
 def boxd_infos(ack, respond, command):
     ack()
     
@@ -117,6 +78,7 @@ def boxd_infos(ack, respond, command):
     )
 
 @app.command("/boxd-events")
+@timed
 def boxd_events(ack, respond, command):
     ack()
 
@@ -129,14 +91,13 @@ def boxd_events(ack, respond, command):
         )
         return
 
-    channel = get_channel(slackid)
-
     app.client.views_open(
-        trigger_id=command["trigger_id"], view=blocks.modal_events(channel, user[4])
+        trigger_id=command["trigger_id"], view=blocks.modal_events(user.channel, user.events)
     )
 
 
 @app.command("/boxd-link")
+@timed
 def boxd_link(ack, respond, command):
     ack()
     username: str = command["text"]
@@ -166,6 +127,8 @@ def boxd_link(ack, respond, command):
     try:
         link_account(command["user_id"], boxdid)
         respond(f":hooray-wx: Successfully linked <@{slackid}> to `{username}`")
+        # So /boxd-together works without waiting for the next refresh
+        Thread(target=index_watchlist, args=(boxdid,), daemon=True).start()
     except duckdb.ConstraintException as e:
         respond(f":panic-wx: Unable to link your account!\nSomeone is already linked to this Letterboxd")
     except Exception as e:
@@ -173,6 +136,7 @@ def boxd_link(ack, respond, command):
 
 
 @app.action("events-change")
+@timed
 def handle_events_change(ack, body, logger):
     ack()
     
@@ -187,11 +151,13 @@ def handle_events_change(ack, body, logger):
     update_events_subscribe(selected_options, user_id)
 
 @app.action("open_letterboxd")
+@timed
 def handle_letterboxd_button(ack):
     ack()
 
 
 @app.command("/boxd-toggle")
+@timed
 def boxd_toggle(ack, respond, command):
     ack()
     state: str = command["text"].lower()
@@ -220,6 +186,7 @@ def boxd_toggle(ack, respond, command):
         
         
 @app.command("/boxd-roll")
+@timed
 def boxd_roll(ack, respond, command):
     ack()
     slackid = command["user_id"]
@@ -232,101 +199,393 @@ def boxd_roll(ack, respond, command):
         )
         return
     
-    film_ids = boxd_client.get_watchlist(boxd_id)
-    film_id = random.choice(film_ids)
-    film = boxd_client.get_film(film_id)
+    film = pick_watchlist_film(boxd_id)
+    if film is None:
+        # The watchlist isn't indexed yet
+        film_ids = boxd_client.get_watchlist(boxd_id)
+        film_id = random.choice(film_ids)
+        film = boxd_client.get_film(film_id)
+        upsert_films([film])
     
     app.client.chat_postMessage(
         channel=command["channel_id"], blocks=blocks.watchlist_pick(film), text=f"Picked {film.full_display_name}"
     )
 
+@app.command("/boxd-stats")
+@timed
+def boxd_stats(ack, respond, command):
+    ack()
+    slackid = command["user_id"]
+    mentions = SLACK_MENTION_PATTERN.findall(command["text"])
+    target_id = mentions[0] if mentions else slackid
+
+    user = get_user(slackid)
+    target = get_user(target_id)
+
+    if user is None:
+        respond(
+            "Link your Letterboxd account before doing this!\nUsing `/boxd-link [username]`"
+        )
+        return
+
+    if target is None:
+        respond(f"<@{target_id}> didn't link their Letterboxd account")
+        return
+
+    overlap = None
+    if target_id != slackid:
+        overlap = get_watchlist_overlap([user.boxd_id, target.boxd_id])
+
+    respond(
+        blocks=blocks.stats(
+            target_id,
+            get_ratings_distribution(target.boxd_id),
+            get_top_genres(target.boxd_id),
+            get_films_per_month(target.boxd_id),
+            overlap,
+        ),
+        text=f"Stats of <@{target_id}>",
+    )
+
+
+@app.command("/boxd-together")
+@timed
+def boxd_together(ack, respond, command):
+    ack()
+    slackid = command["user_id"]
+    ranked = "top" in command["text"].lower().split()
+
+    slack_ids = [slackid]
+    for mention in SLACK_MENTION_PATTERN.findall(command["text"]):
+        if mention not in slack_ids:
+            slack_ids.append(mention)
+
+    if len(slack_ids) < 2:
+        respond("Mention who you want to watch a film with\nExample: `/boxd-together @someone [top]`")
+        return
+
+    users = [get_user(slack_id) for slack_id in slack_ids]
+    unlinked = [slack_id for slack_id, user in zip(slack_ids, users) if user is None]
+    if unlinked:
+        mentions = ", ".join(f"<@{slack_id}>" for slack_id in unlinked)
+        respond(f"{mentions} didn't link their Letterboxd account")
+        return
+
+    boxd_ids = [user.boxd_id for user in users]
+    indexed = get_indexed_watchlists(boxd_ids)
+    missing = [user.slack_id for user in users if user.boxd_id not in indexed]
+    if missing:
+        mentions = ", ".join(f"<@{slack_id}>" for slack_id in missing)
+        respond(f":hourglass: The watchlist of {mentions} is empty or not indexed yet, try again in a few minutes")
+        for user in users:
+            if user.boxd_id not in indexed:
+                Thread(target=index_watchlist, args=(user.boxd_id,), daemon=True).start()
+        return
+
+    films = get_watchlist_overlap(boxd_ids, limit=10 if ranked else 1, ranked=ranked)
+    if len(films) == 0:
+        respond(":sob: There's no film on everyone's watchlist")
+        return
+
+    app.client.chat_postMessage(
+        channel=command["channel_id"],
+        blocks=blocks.together_pick(slack_ids, films, ranked),
+        text=f"Picked {films[0][1]}",
+    )
+
+
+DIGEST_EVENTS = {
+    "watchlist": "WatchlistActivity",
+    "diary": "DiaryEntryActivity",
+    "follow": "FollowActivity",
+}
+DIGEST_EVENTS_NAMES = {
+    "WatchlistActivity": "watchlist additions",
+    "DiaryEntryActivity": "diary entries",
+    "FollowActivity": "follows",
+}
+
+
+@app.command("/boxd-digest")
+@timed
+def boxd_digest(ack, respond, command):
+    ack()
+    slackid = command["user_id"]
+    args = command["text"].lower().split()
+
+    if get_user(slackid) is None:
+        respond(
+            "Link your Letterboxd account before doing this!\nUsing `/boxd-link [username]`"
+        )
+        return
+
+    if len(args) != 2 or args[0] not in DIGEST_EVENTS or args[1] not in [*DIGEST_PERIODS, "off"]:
+        respond(
+            "Usage: `/boxd-digest [watchlist|diary|follow] [hourly|daily|off]`\nExample: `/boxd-digest diary daily`"
+        )
+        return
+
+    event, period = args
+    set_digest(slackid, DIGEST_EVENTS[event], None if period == "off" else period)
+
+    if period == "off":
+        respond(f"Your {DIGEST_EVENTS_NAMES[DIGEST_EVENTS[event]]} will be posted right away")
+    else:
+        respond(f"Your {DIGEST_EVENTS_NAMES[DIGEST_EVENTS[event]]} will be posted in a {period} digest")
+
+
 @app.shortcut("delete_message")
+@timed
 def delete_message(ack, body, logger):
     ack()
-    
-    metadata = body["message"].get("metadata")
-    
-    if metadata == None:
+
+    channel = body["channel"]["id"]
+    ts = body["message"]["ts"]
+
+    author = get_post_author(channel, ts)
+    if author is None:
+        # Posted before the registry existed
+        metadata = body["message"].get("metadata") or {}
+        author = (metadata.get("event_payload") or metadata).get("author_slack_id")
+
+    if body["user"]["id"] == author:
+        app.client.chat_delete(ts=ts, channel=channel)
+        delete_posts([(channel, ts)])
+
+
+def purge_posts(slack_id):
+    """
+    Delete every registered message of a user, within chat.delete's rate limit
+
+    Messages that couldn't be deleted stay registered, so a later purge retries them.
+
+    :return: Number of deleted messages, and of messages that couldn't be deleted
+    :rtype: tuple[int, int]
+    """
+    posts = get_user_posts(slack_id)
+    deleted = []
+    total_deleted = 0
+    failed = 0
+
+    for channel, ts in posts:
+        while True:
+            try:
+                app.client.chat_delete(channel=channel, ts=ts)
+                deleted.append((channel, ts))
+                break
+            except SlackApiError as e:
+                if e.response["error"] == "ratelimited":
+                    time.sleep(int(e.response.headers.get("Retry-After", 1)))
+                    continue
+                if e.response["error"] == "message_not_found":
+                    # Already deleted by hand
+                    deleted.append((channel, ts))
+                else:
+                    logger.warning("Unable to delete %s in %s: %s", ts, channel, e)
+                    failed += 1
+                break
+
+        time.sleep(PURGE_DELAY)
+
+        if len(deleted) >= 100:
+            delete_posts(deleted)
+            total_deleted += len(deleted)
+            deleted = []
+
+    delete_posts(deleted)
+    return total_deleted + len(deleted), failed
+
+
+@app.command("/boxd-purge")
+@timed
+def boxd_purge(ack, respond, command):
+    ack()
+    slackid = command["user_id"]
+
+    posts = len(get_user_posts(slackid))
+    if posts == 0:
+        respond("There's no message to delete")
         return
-    
-    if body["user"]["id"] == metadata["event_payload"].get("author_slack_id"):
-        app.client.chat_delete(
-            ts=body["message"]["ts"], channel=body["channel"]["id"]
-        )
+
+    respond(f":wastebasket: Deleting {posts} messages, this can take around {round(posts * PURGE_DELAY / 60) + 1} minutes")
+
+    def purge():
+        deleted, failed = purge_posts(slackid)
+        text = f"Deleted {deleted} Letterboxd messages"
+        if failed:
+            text += f", {failed} couldn't be deleted, run `/boxd-purge` again to retry"
+        app.client.chat_postMessage(channel=slackid, text=text)
+
+    Thread(target=purge, daemon=True).start()
+
+
+def is_rate_limited(error):
+    """Check if a poll failed because Slack or Letterboxd rate limited it"""
+    if isinstance(error, SlackApiError):
+        return error.response["error"] == "ratelimited"
+
+    # requests' HTTPError, raised for Letterboxd responses
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) == 429
 
 
 def post_activities():
-    users = get_configured_users()
-    for user in users:
-        activities = boxd_client.get_activity(user[1])
-
-        for activity in activities:
-            if activity.when_created < user[3]:
-                continue
-
-            blocks_message = None
-            text_message = None
-            metadatas = None
-            member = activity.member
-            subscribed_events = user[4]
-            if isinstance(activity, FollowActivity) and "FollowActivity" in subscribed_events:
-                text_message = f"{member.display_name} followed <https://letterboxd.com/{activity.followed.username}|{activity.followed.display_name}>"
-                blocks_message = blocks.from_mrkdwn(text_message)
-                metadatas = {
-                    "author_boxd_id": activity.member.id,
-                    "author_slack_id": user[0],
-                    "following_boxd_id": activity.followed.id
-                }
-
-            elif isinstance(activity, WatchlistActivity) and "WatchlistActivity" in subscribed_events:
-                if activity.film.adult:
-                    continue
+    # Registry rows of the whole tick, written at once
+    posts = []
 
-                filmName = activity.film.full_display_name or activity.film.name
-                text_message = f"{member.display_name} added {filmName} to {member.pronoun.possessive_pronoun} watchlist"
-                blocks_message = blocks.from_mrkdwn(text_message)
-                metadatas = {
-                    "event_type": "WatchlistActivity",
-                    "event_payload": {
-                        "author_boxd_id": activity.member.id,
-                        "author_slack_id": user[0],
-                        "movie_id": activity.film.id
-                    }
-                }
-
-            elif isinstance(activity, DiaryEntryActivity) and "DiaryEntryActivity" in subscribed_events:
-                if activity.film.adult:
-                    continue
+    # Users polled the longest time ago go first, so the ones left out by a
+    # small batch are polled next tick
+    users = sorted(get_configured_users(), key=lambda user: user.last_update)
+    batch = users[:load_controller.batch_size]
+    deferred_events = load_controller.deferred_events
 
-                text_message = f"{member.display_name} logged {activity.film.full_display_name or activity.film.name} ({activity.rating} stars)"
-                blocks_message = blocks.from_diaryentry(activity)
-                metadatas = {
-                    "event_type": "DiaryEntryActivity",
-                    "event_payload": {
-                        "author_boxd_id": activity.member.id,
-                        "author_slack_id": user[0],
-                        "movie_id": activity.film.id
-                    }
-                }
-
-            if blocks_message is None:
-                continue
-
-            app.client.chat_postMessage(
-                channel=user[2], blocks=blocks_message, text=text_message,
-                metadata=metadatas
+    rate_limited = []
+
+    def poll(user):
+        try:
+            return post_user_activities(
+                user, boxd_client, app.client, deferred_events=deferred_events, posts=posts
             )
+        except Exception as e:
+            logger.exception("Unable to poll %s", user.slack_id)
+            if is_rate_limited(e):
+                rate_limited.append(user.slack_id)
+            return None
+
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=load_controller.workers) as pool:
+            results = list(pool.map(poll, batch))
+    finally:
+        record_posts(posts)
+
+    new_activities = [activity for result in results if result for activity in result]
+    record_activities(new_activities)
+
+    load_controller.record_tick(
+        time.monotonic() - start,
+        polled=len(batch),
+        pending=len(users) - len(batch),
+        errors=results.count(None),
+        rate_limited=len(rate_limited),
+    )
+
+
+def post_digests():
+    """
+    Send the buffered activities whose digest period is over
+
+    Messages stay buffered until their digest is posted, a failed one is retried next run.
+    """
+    for slack_id, event_type, texts, until in get_due_digests():
+        user = get_user(slack_id)
+        if user is None or user.channel is None:
+            # Unlinked or logging disabled, nowhere to post them
+            delete_digest(slack_id, event_type, until)
+            continue
+
+        title = f"{len(texts)} new {DIGEST_EVENTS_NAMES[event_type]}"
+        posts = []
+        try:
+            for message_blocks in blocks.digest(title, texts):
+                resp = app.client.chat_postMessage(
+                    channel=user.channel, blocks=message_blocks, text=title,
+                    metadata={
+                        "event_type": "Digest",
+                        "event_payload": {"author_slack_id": slack_id},
+                    },
+                )
+                posts.append((resp["channel"], resp["ts"], slack_id, None))
+        except Exception:
+            logger.exception("Unable to post the %s digest of %s", event_type, slack_id)
+            continue
+        finally:
+            record_posts(posts)
+
+        delete_digest(slack_id, event_type, until)
 
-        update_lastUpdate(user[0])
+
+def refresh_films():
+    """Refresh the oldest entries of the film catalogue in bulk, then fill missing ratings"""
+    film_ids = get_stale_film_ids()
+    if film_ids:
+        upsert_films(boxd_client.get_films(film_ids))
+
+    # Batches and watchlists only return summaries, the rating needs the full film
+    films = []
+    for film_id in get_unrated_film_ids():
+        try:
+            films.append(boxd_client.get_film(film_id))
+        except Exception:
+            logger.exception("Unable to fetch the film %s", film_id)
+
+    if films:
+        upsert_films(films)
+
+
+def index_watchlist(boxd_id):
+    """Re-index the whole watchlist of a member, errors are logged"""
+    try:
+        replace_watchlist(boxd_id, boxd_client.get_watchlist_films(boxd_id))
+    except Exception:
+        logger.exception("Unable to index the watchlist of %s", boxd_id)
+
+
+def refresh_watchlists():
+    """Re-index the whole watchlist of every linked account"""
+    for user in get_users():
+        index_watchlist(user.boxd_id)
 
 
 if __name__ == "__main__":
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_MAX_INSTANCES
+
+    logging.basicConfig(level=logging.INFO)
     init_db()
 
+    # Exit cleanly on docker stop, so the Letterboxd archive gets its trailer
+    atexit.register(boxd_client.close)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    # Slack spreads events over every open connection, and falls back to
+    # the others if one drops
+    handlers = [
+        SocketModeHandler(app, concurrency=int(getenv("SLACK_SOCKET_CONCURRENCY", 10)))
+        for _ in range(int(getenv("SLACK_SOCKET_CONNECTIONS", 2)))
+    ]
+    for handler in handlers:
+        handler.connect()
+
+    # The catch-up poll runs right away in the scheduler's thread, so
+    # commands are answered while every user is being polled
     scheduler = BackgroundScheduler()
-    scheduler.add_job(post_activities, "interval", minutes=30)
+    scheduler.add_job(
+        post_activities, "interval", seconds=POLL_INTERVAL,
+        id="post_activities", next_run_time=datetime.now(),
+        max_instances=1, coalesce=True,
+    )
+
+    def on_poll_event(event):
+        if event.job_id != "post_activities":
+            return
+
+        if event.code == EVENT_JOB_MAX_INSTANCES:
+            load_controller.record_missed_run()
+
+        # Show the load state in the job list
+        scheduler.modify_job("post_activities", name=f"post_activities ({load_controller})")
+
+    scheduler.add_listener(on_poll_event, EVENT_JOB_EXECUTED | EVENT_JOB_MAX_INSTANCES)
+    scheduler.add_job(post_digests, "interval", minutes=10)
+    # Picks up accounts imported with cli.py while the bot is running
+    scheduler.add_job(load_accounts, "interval", minutes=5)
+    scheduler.add_job(refresh_films, "interval", hours=6)
+    # Started after the catch-up poll rather than next to it
+    scheduler.add_job(
+        refresh_watchlists, "interval", hours=12,
+        next_run_time=datetime.now() + timedelta(minutes=10),
+    )
     scheduler.start()
 
-    handler = SocketModeHandler(app)
-    post_activities()
-    handler.start()
+    Event().wait()
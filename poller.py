@@ -0,0 +1,127 @@
+"""
+Post the new Letterboxd activities of linked accounts
+
+Kept apart from the bot so that cli.py can backfill and replay without
+creating the Slack app.
+"""
+
+import blocks
+from database import Account, activity_id, record_posts, buffer_digest, update_lastUpdate
+from schemas import FollowActivity, WatchlistActivity, DiaryEntryActivity
+
+# Slack ID -> IDs of the activities posted by a poll that failed before the end
+_partially_posted: dict[str, set[str]] = {}
+
+
+def post_user_activities(user: Account, boxd_client, client, since=None, deferred_events=(), posts=None):
+    """
+    Post the user's new activities in their channel
+
+    :param user: Account to poll
+    :type user: Account
+    :param boxd_client: Letterboxd client to poll with
+    :type boxd_client: LetterboxdClient
+    :param client: Slack client to post with
+    :type client: WebClient
+    :param since: Only post activities created after this date, defaults to the last update
+    :type since: datetime
+    :param deferred_events: Event types sent to a digest instead of being posted
+    :type deferred_events: list[str]
+    :param posts: Collects the registry rows of the posted messages for the caller to record,
+        they are recorded right away by default
+    :type posts: list
+    :return: The new activities
+    :rtype: list[AbstractActivity]
+    """
+    if since is None:
+        since = user.last_update
+
+    record = posts is None
+    if record:
+        posts = []
+
+    activities = []
+    digest_messages = []
+    # Includes the messages sent by a previous poll that failed halfway through
+    posted = set(_partially_posted.get(user.slack_id, ()))
+    try:
+        # Each activity is posted as soon as it is parsed, the rest of the page
+        # is still downloading
+        for activity in boxd_client.iter_activity(user.boxd_id, since=since):
+            activities.append(activity)
+            blocks_message = None
+            text_message = None
+            metadatas = None
+            member = activity.member
+            subscribed_events = user.events
+            if isinstance(activity, FollowActivity) and "FollowActivity" in subscribed_events:
+                text_message = f"{member.display_name} followed <https://letterboxd.com/{activity.followed.username}|{activity.followed.display_name}>"
+                blocks_message = blocks.from_mrkdwn(text_message)
+                metadatas = {
+                    "event_type": "FollowActivity",
+                    "event_payload": {
+                        "author_boxd_id": activity.member.id,
+                        "author_slack_id": user.slack_id,
+                        "following_boxd_id": activity.followed.id
+                    }
+                }
+
+            elif isinstance(activity, WatchlistActivity) and "WatchlistActivity" in subscribed_events:
+                if activity.film.adult:
+                    continue
+
+                filmName = activity.film.full_display_name or activity.film.name
+                text_message = f"{member.display_name} added {filmName} to {member.pronoun.possessive_pronoun} watchlist"
+                blocks_message = blocks.from_mrkdwn(text_message)
+                metadatas = {
+                    "event_type": "WatchlistActivity",
+                    "event_payload": {
+                        "author_boxd_id": activity.member.id,
+                        "author_slack_id": user.slack_id,
+                        "movie_id": activity.film.id
+                    }
+                }
+
+            elif isinstance(activity, DiaryEntryActivity) and "DiaryEntryActivity" in subscribed_events:
+                if activity.film.adult:
+                    continue
+
+                text_message = f"{member.display_name} logged {activity.film.full_display_name or activity.film.name} ({activity.rating} stars)"
+                blocks_message = blocks.from_diaryentry(activity)
+                metadatas = {
+                    "event_type": "DiaryEntryActivity",
+                    "event_payload": {
+                        "author_boxd_id": activity.member.id,
+                        "author_slack_id": user.slack_id,
+                        "movie_id": activity.film.id
+                    }
+                }
+
+            if blocks_message is None:
+                continue
+
+            if activity_id(activity) in posted:
+                continue
+
+            if activity.type in user.digests or activity.type in deferred_events:
+                digest_messages.append((user.slack_id, activity.type, text_message))
+                continue
+
+            resp = client.chat_postMessage(
+                channel=user.channel, blocks=blocks_message, text=text_message,
+                metadata=metadatas
+            )
+            posts.append((resp["channel"], resp["ts"], user.slack_id, activity_id(activity)))
+            posted.add(activity_id(activity))
+    except Exception:
+        # lastUpdate isn't moved so the rest is retried, without reposting these
+        _partially_posted[user.slack_id] = posted
+        raise
+    finally:
+        if record:
+            record_posts(posts)
+
+    _partially_posted.pop(user.slack_id, None)
+    buffer_digest(digest_messages)
+    update_lastUpdate(user.slack_id)
+    return activities
@@ -0,0 +1,65 @@
+"""
+Pick which poster size is sent to Slack
+
+Slack downloads the image of every message itself, so the smallest size
+that still looks sharp in a message is used instead of a full size poster.
+"""
+
+from os import getenv
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from schemas import Film
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Width in pixels the poster should at least have
+POSTER_TARGET_WIDTH = int(getenv("POSTER_TARGET_WIDTH", 150))
+# Request new posters once so the CDN has them before Slack asks
+POSTER_PREWARM = getenv("POSTER_PREWARM", "false").lower() == "true"
+
+_MAX_CACHED = 10_000
+
+_urls: dict[str, str | None] = {}
+_urls_lock = Lock()
+_prewarm_pool = ThreadPoolExecutor(max_workers=4) if POSTER_PREWARM else None
+
+
+def _prewarm(url):
+    import requests
+
+    try:
+        requests.head(url, timeout=5)
+    except requests.RequestException:
+        pass
+
+
+def poster_url(film: Film) -> str | None:
+    """
+    Get the URL of the smallest poster at least POSTER_TARGET_WIDTH wide
+
+    :param film: Film to get the poster of
+    :type film: Film
+    :return: The poster URL, the largest one if none is wide enough, None if there is no poster
+    :rtype: str or None
+    """
+    if film.id in _urls:
+        return _urls[film.id]
+
+    url = None
+    if film.poster is not None and len(film.poster.sizes) > 0:
+        sizes = sorted(film.poster.sizes, key=lambda size: size.width)
+        url = next(
+            (size.url for size in sizes if size.width >= POSTER_TARGET_WIDTH),
+            sizes[-1].url,
+        )
+
+    with _urls_lock:
+        if len(_urls) >= _MAX_CACHED:
+            _urls.clear()
+        _urls[film.id] = url
+
+    if url is not None and _prewarm_pool is not None:
+        _prewarm_pool.submit(_prewarm, url)
+
+    return url
@@ -2,8 +2,16 @@
 Utility functions used across the project
 """
 
+import time
+import inspect
+import logging
+import functools
 from datetime import datetime
-from bs4 import BeautifulSoup
+
+logger = logging.getLogger(__name__)
+
+# Slack shows an error if an interaction isn't acknowledged in time
+SLACK_ACK_DEADLINE = 3
 
 
 def format_boxd_date(date: str):
@@ -49,6 +57,8 @@ def html_to_mrkdwn(html: str) -> str:
     :return: mrkdwn to use in slack
     :rtype: str
     """
+    # Only reviews need it, so don't pay for the import at startup
+    from bs4 import BeautifulSoup
 
     soup = BeautifulSoup(html, "html.parser")
 
@@ -77,3 +87,40 @@ def html_to_mrkdwn(html: str) -> str:
         bq.replace_with(quoted)
 
     return soup.get_text()
+
+
+def timed(listener):
+    """
+    Log how long a Slack listener takes to acknowledge and to finish
+
+    A warning is logged when ack() is called past Slack's deadline, the rest
+    of the work can be as slow as it needs. The signature is kept so Bolt
+    still injects the same arguments.
+
+    :param listener: Bolt listener function
+    """
+    @functools.wraps(listener)
+    def wrapper(**kwargs):
+        start = time.monotonic()
+        acked_after = None
+
+        if "ack" in kwargs:
+            ack = kwargs["ack"]
+
+            def timed_ack(*args, **ack_kwargs):
+                nonlocal acked_after
+                acked_after = time.monotonic() - start
+                return ack(*args, **ack_kwargs)
+
+            kwargs["ack"] = timed_ack
+
+        try:
+            return listener(**kwargs)
+        finally:
+            elapsed = time.monotonic() - start
+            if acked_after is not None and acked_after > SLACK_ACK_DEADLINE:
+                logger.warning("%s acknowledged after %.2fs", listener.__name__, acked_after)
+            logger.info("%s took %.2fs", listener.__name__, elapsed)
+
+    wrapper.__signature__ = inspect.signature(listener)
+    return wrapper